@@ -1,10 +1,14 @@
+import math
 import sympy
-from sympy.assumptions.assume import AppliedPredicate, global_assumptions
-from typing import Dict, List, Union
+from functools import lru_cache
+from sympy.assumptions.assume import AppliedPredicate
+from typing import Callable, Dict, FrozenSet, List, Optional, Set, Tuple, Union
 
 a, b, c = sympy.symbols('a b c')
 d_a, d_b, d_c = sympy.symbols('Δa Δb Δc')
 
+DELTA_CHAR = '\\Delta '  # prefixes the latex of a variable to name its uncertainty, as the frontend does
+
 
 class Expression:
     args: List[sympy.Symbol]
@@ -25,6 +29,8 @@ class Expression:
         """
         self.args = args
         self.expr = expr
+        self._symbols = tuple(sorted(expr.free_symbols, key=str))
+        self._latex = None
 
     def __repr__(self) -> str:
         """Show this expression as a mathematical function.
@@ -40,6 +46,34 @@ class Expression:
             return f"f({self.args[0]}) = {self.expr}"
         return f"f{tuple(self.args)} = {self.expr}"
 
+    def __eq__(self, other: object) -> bool:
+        """Check whether both expressions have the same args and mathematical expression.
+
+        >>> Expression([a, b], a * b) == Expression([a, b], a * b)
+        True
+        >>> Expression([a, b], a * b) == Expression([b, a], a * b)
+        False
+        """
+        if not isinstance(other, Expression):
+            return NotImplemented
+        return self.expr == other.expr and tuple(self.args) == tuple(other.args)
+
+    def __hash__(self) -> int:
+        return hash((self.expr, tuple(self.args)))
+
+    @classmethod
+    def intern(cls, args: List[sympy.Symbol], expr: sympy.Expr) -> 'Expression':
+        """Get the Expression with the given args and expression, reusing a recently used instance if there is one,
+        so that identical formulas parsed by different requests are the same object.
+
+        The uncertainties and numeric functions are cached by expression elsewhere, so this only saves rebuilding
+        the instance itself (its sorted free symbols, and its latex once printed).
+
+        >>> Expression.intern([a], a * b) is Expression.intern([a], a * b)
+        True
+        """
+        return _interned_expression(cls, expr, tuple(args))
+
     def evaluate(self, values: Dict[Union[str, sympy.Symbol], float], precision: int =3) -> sympy.Expr:
         """Evaluate the expression with the given values.
 
@@ -51,14 +85,52 @@ class Expression:
         6.00
         >>> Expression([a, b, c], a ** b + c).evaluate({'a': c, 'b': 1})
         2.0*c
+        >>> Expression([a, b], a / b).evaluate({'a': 1, 'b': 0})
+        zoo
+        >>> Expression([a], a * 1e308).evaluate({'a': 10})
+        1.00e+309
+        >>> Expression.from_string(['a'], 'a / 0').evaluate({'a': 2})
+        zoo
+        >>> Expression([a], a).calculate_absolute_uncertainty(delta_char='Δ').evaluate({d_a: c})
+        c
         """
+        if precision <= 15:  # within what a float carries
+            numbers = []
+            for symbol in self._symbols:
+                value = values.get(symbol, values.get(str(symbol)))
+                if not isinstance(value, (int, float)) or isinstance(value, bool):
+                    break
+                numbers.append(value)
+            else:
+                try:
+                    result = _lambdified(self._symbols, self.expr)(*numbers)
+                    if math.isfinite(result):  # overflows and zoo (printed as nan) are left to subs
+                        return sympy.Float(result, precision) if result else sympy.Integer(0)  # as evalf does
+                except (ArithmeticError, NameError, ValueError, TypeError):
+                    pass  # e.g. a complex result, or a function math lacks: let subs deal with it
+        # match keys by name, as symbols created with assumptions (like the deltas) differ from plain ones
+        names = {str(symbol): symbol for symbol in self._symbols}
+        values = {names.get(str(key), key): value for key, value in values.items()}
         return self.expr.subs(values).evalf(precision)
 
+    def _uncertain_args(self, assumptions: Tuple[AppliedPredicate, ...], uncertain_vars: Optional[List[sympy.Symbol]]
+                        ) -> Tuple[Tuple[sympy.Symbol, ...], FrozenSet[AppliedPredicate]]:
+        """Get the args to differentiate with respect to, and the assumptions to refine with.
+
+        The args left out still count as positive, like every arg does when refining.
+        """
+        if uncertain_vars is None:
+            return tuple(self.args), frozenset(assumptions)
+        skipped_args = [var for var in self.args if var not in uncertain_vars]
+        return tuple(uncertain_vars), frozenset(assumptions).union(sympy.Q.positive(var) for var in skipped_args)
+
     def calculate_absolute_uncertainty(self, *assumptions: List[AppliedPredicate],
                                        refine: bool = False,
-                                       delta_char: str = '\\Delta ') -> 'Expression':
+                                       delta_char: str = DELTA_CHAR,
+                                       uncertain_vars: Optional[List[sympy.Symbol]] = None) -> 'Expression':
         """Calculate the absolute uncertainty in the expression (IB way), assuming all args given are independent.
 
+        :param uncertain_vars: the args that have an uncertainty, all of them if None
         :return: the absolute uncertainty of this expression
         :rtype: Expression
 
@@ -66,26 +138,19 @@ class Expression:
         f(Δa) = c*Δa
         >>> Expression([a, b, c], a + b - c).calculate_absolute_uncertainty(refine=True, delta_char='Δ')
         f(Δa, Δb, Δc) = Δa + Δb + Δc
+        >>> Expression([a, b], a * b).calculate_absolute_uncertainty(refine=True, delta_char='Δ', uncertain_vars=[a])
+        f(Δa) = b*Δa
         """
-        uncertainty_expr = sympy.Integer(0)  # just in case
-        uncertainty_args = []
-        global_assumptions.add(*assumptions)
-
-        for var in self.args:
-            d_var = sympy.Symbol(delta_char + sympy.latex(var))
-            uncertainty_args.append(d_var)
-            uncertainty_expr += sympy.Abs(self.expr.diff(var)) * d_var
-            global_assumptions.add(sympy.Q.positive(var))
-        if refine:
-            uncertainty_expr = sympy.refine(uncertainty_expr)
-        global_assumptions.clear()
-        return Expression(uncertainty_args, uncertainty_expr)
+        args, assumptions = self._uncertain_args(assumptions, uncertain_vars)
+        return _abs_uncertainty_cached(self.expr, args, assumptions, refine, delta_char)
 
     def calculate_fractional_uncertainty(self, *assumptions: List[AppliedPredicate],
                                          refine: bool = False,
-                                         delta_char: str = '\\Delta ') -> 'Expression':
+                                         delta_char: str = DELTA_CHAR,
+                                         uncertain_vars: Optional[List[sympy.Symbol]] = None) -> 'Expression':
         """Calculate the absolute uncertainty in the expression (IB way), assuming all args given are independent.
 
+        :param uncertain_vars: the args that have an uncertainty, all of them if None
         :return: the fractional uncertainty of this expression
         :rtype: Expression
 
@@ -93,17 +158,18 @@ class Expression:
         f(Δa, Δb, Δc) = Δc/c + Δb/b + Δa/a
         >>> Expression([a], a ** b).calculate_fractional_uncertainty(sympy.Q.positive(b), refine=True, delta_char='Δ')
         f(Δa) = b*Δa/a
+        >>> Expression([a], sympy.sin(a)).calculate_fractional_uncertainty(delta_char='Δ')
+        f(Δa) = Δa*Abs(cos(a))/Abs(sin(a))
+        >>> Expression([a], a - b).calculate_fractional_uncertainty(delta_char='Δ')
+        f(Δa) = Δa/Abs(a - b)
+        >>> Expression([a, b], a + b).calculate_fractional_uncertainty(uncertain_vars=[])
+        f() = 0
+        >>> undefined = Expression.from_string(['a'], 'a / 0')
+        >>> undefined.calculate_fractional_uncertainty(delta_char='Δ').evaluate({'a': 2, 'Δa': 1})
+        nan
         """
-        absolute_uncertainty = self.calculate_absolute_uncertainty(*assumptions, refine=refine, delta_char=delta_char)
-        frac_uncertainty_expr = sympy.Integer(0)
-        if type(absolute_uncertainty.expr) == sympy.Add:
-            for addend in absolute_uncertainty.expr.args:
-                frac_uncertainty_expr += addend / self.expr
-        elif type(absolute_uncertainty.expr) == sympy.Mul or type(absolute_uncertainty) == sympy.Pow:
-            frac_uncertainty_expr = absolute_uncertainty.expr / self.expr
-        else:
-            frac_uncertainty_expr = sympy.Mul(absolute_uncertainty.expr, sympy.Pow(self.expr, -1), evaluate=False)
-        return Expression(absolute_uncertainty.args, frac_uncertainty_expr)
+        args, assumptions = self._uncertain_args(assumptions, uncertain_vars)
+        return _frac_uncertainty_cached(self.expr, args, assumptions, refine, delta_char)
 
     def to_latex(self) -> str:
         r"""Get the latex form of this expression.
@@ -117,22 +183,189 @@ class Expression:
         >>> Expression([a, b, c], sympy.root(a ** b, c)).to_latex()
         '\\left(a^{b}\\right)^{\\frac{1}{c}}'
         """
-        return sympy.latex(self.expr)
+        if self._latex is None:  # expr never changes, so print it once
+            self._latex = sympy.latex(self.expr)
+        return self._latex
 
     @classmethod
-    def from_string(cls, args_list: List[str], string: str, constants: Dict[str, float] = None) -> 'Expression':
+    def from_string(cls, args_list: List[str], string: str, constants: Dict[str, float] = None,
+                    positive_vars: List[str] = None) -> 'Expression':
         """Parse a string expression.
 
         :param string: expression as a string of python expressions
         :param args_list: the list of args / independent variables of the expression as strings
         :param constants: a list of local variables that are considered while parsing
+        :param positive_vars: the variables known to be positive, which become symbols declared positive
         :return: an expression taking in the given args
 
         >>> Expression.from_string(['x'], 'sqrt(x) ^ y')
         f(x) = (sqrt(x))**y
         >>> Expression.from_string(['m'], 'm * g', constants={'g': 9.81})
         f(m) = 9.81*m
+        >>> Expression.from_string(['x'], 'x * y', positive_vars=['x']).args[0].is_positive
+        True
+        >>> import weakref
+        >>> parsed = weakref.ref(Expression.from_string(['x'], 'x * z'))  # nothing else holds on to the instance
+        >>> parsed() is Expression.from_string(['x'], 'x * z')
+        True
         """
-        parsed_expr = sympy.sympify(string, evaluate=False, locals=constants)  # note: uses eval
+        # declared through the symbols themselves, the old assumptions know the sign without refine
+        local_dict = {name: sympy.Symbol(name, positive=True) for name in positive_vars or []}
+        local_dict.update(constants or {})
+        parsed_expr = sympy.sympify(string, evaluate=False, locals=local_dict)  # note: uses eval
         args = [symbol for symbol in parsed_expr.atoms(sympy.Symbol) if str(symbol) in args_list]
-        return cls(args, parsed_expr)
+        return cls.intern(args, parsed_expr)
+
+
+@lru_cache(maxsize=512)
+def _interned_expression(cls: type, expr: sympy.Expr, args_tuple: Tuple[sympy.Symbol, ...]) -> Expression:
+    """Construct the Expression for Expression.intern, keeping the most recently used ones alive."""
+    return cls(list(args_tuple), expr)
+
+
+@lru_cache(maxsize=512)
+def _lambdified(symbols: Tuple[sympy.Symbol, ...], expr: sympy.Expr) -> Callable[..., float]:
+    """Compile expr into a math-backed function of symbols, shared by every Expression with the same expr.
+
+    Compiling costs far more than one subs, so it only pays off because the result is kept here across requests.
+    """
+    return sympy.lambdify(symbols, expr, modules='math', dummify=True)
+
+
+@lru_cache(maxsize=1024)
+def _delta_symbol(var: sympy.Symbol, delta_char: str) -> sympy.Symbol:
+    """Get the symbol for the uncertainty in var, which is never negative.
+
+    >>> _delta_symbol(a, 'Δ')
+    Δa
+    >>> _delta_symbol(a, 'Δ').is_positive
+    True
+    """
+    return sympy.Symbol(delta_char + sympy.latex(var), positive=True)
+
+
+def _positive_symbol(symbol: sympy.Symbol) -> sympy.Symbol:
+    """Get a positive symbol of the same name, for the old assumptions to reason about the sign of symbol."""
+    return sympy.Symbol(symbol.name, positive=True)
+
+
+def _safe_abs(term: sympy.Expr, positive_syms: Set[sympy.Symbol]) -> sympy.Expr:
+    """Take the absolute value of term, leaving out Abs wherever the sign is known without refine.
+
+    :param positive_syms: the symbols that are known to be positive
+
+    >>> _safe_abs(-2 * a / b, {a, b})
+    2*a/b
+    >>> _safe_abs(-b * sympy.cos(a), {a, b})
+    b*Abs(cos(a))
+    >>> _safe_abs(a - b, {a, b})
+    Abs(a - b)
+    """
+    assumed = term.xreplace({symbol: _positive_symbol(symbol) for symbol in positive_syms})
+    if assumed.is_positive:
+        return term
+    if (-assumed).is_positive:
+        return -term
+    if isinstance(term, sympy.Mul):
+        return sympy.Mul(*[_safe_abs(factor, positive_syms) for factor in term.args])
+    return sympy.Abs(term)
+
+
+def _refine_context(expr: sympy.Expr, args_tuple: Tuple[sympy.Symbol, ...],
+                    assumptions_frozenset: FrozenSet[AppliedPredicate]) -> Tuple[Set[sympy.Symbol], sympy.Basic]:
+    """Get the symbols of expr known to be positive when refining (every arg, and those assumed positive),
+    and the assumptions to refine with.
+    """
+    positive_syms = set(args_tuple) | {symbol for symbol in expr.free_symbols
+                                       if sympy.Q.positive(symbol) in assumptions_frozenset}
+    # passed explicitly to refine rather than through global_assumptions, which is shared between requests
+    context = sympy.And(*assumptions_frozenset, *[sympy.Q.positive(var) for var in args_tuple])
+    return positive_syms, context
+
+
+def _magnitude(term: sympy.Expr, positive_syms: Set[sympy.Symbol], context: sympy.Basic, refine: bool) -> sympy.Expr:
+    """Take the absolute value of term, simplified using the positive symbols and context if refine is set.
+
+    >>> _magnitude(-a * sympy.cos(b), {a, b}, sympy.Q.positive(a) & sympy.Q.positive(b), True)
+    a*Abs(cos(b))
+    >>> _magnitude(-a, set(), sympy.true, False)
+    Abs(a)
+    """
+    if refine:
+        term = _safe_abs(term, positive_syms)
+        if term.has(sympy.Abs):  # only the factors whose sign is still unknown need refine
+            term = sympy.refine(term, context)
+        return term
+    return term if term.is_positive else sympy.Abs(term)  # decided by the old assumptions
+
+
+def delta_name(var: sympy.Symbol, delta_char: str = DELTA_CHAR) -> str:
+    """Get the name of the uncertainty in var, which is also how values are keyed for it.
+
+    >>> delta_name(a)
+    '\\\\Delta a'
+    """
+    return _delta_symbol(var, delta_char).name
+
+
+@lru_cache(maxsize=512)
+def _abs_uncertainty_cached(expr: sympy.Expr, args_tuple: Tuple[sympy.Symbol, ...],
+                            assumptions_frozenset: FrozenSet[AppliedPredicate],
+                            refine: bool, delta_char: str) -> Expression:
+    """Calculate the absolute uncertainty of expr with respect to args_tuple, memoized on all of its arguments.
+
+    The returned Expression is shared between callers and should not be mutated.
+    The fractional uncertainty of f reuses the entry for f, except for products and powers,
+    which go through their own entry for log f (see _frac_uncertainty_cached).
+
+    >>> uncertainty = _abs_uncertainty_cached(a * b, (a, b), frozenset(), True, 'Δ')
+    >>> uncertainty is _abs_uncertainty_cached(a * b, (a, b), frozenset(), True, 'Δ')
+    True
+    """
+    uncertainty_args = [_delta_symbol(var, delta_char) for var in args_tuple]
+    positive_syms, context = _refine_context(expr, args_tuple, assumptions_frozenset)
+    free_symbols = expr.free_symbols
+    # an arg not in the expression has a derivative of 0, no need to walk the expression for it
+    derivatives = [expr.diff(var) if var in free_symbols else sympy.Integer(0) for var in args_tuple]
+    terms = [_magnitude(term, positive_syms, context, refine) * d_var
+             for d_var, term in zip(uncertainty_args, derivatives)]
+    uncertainty_expr = sympy.Add(*terms)  # summed once rather than re-sorting a growing sum on every term
+    return Expression(uncertainty_args, uncertainty_expr)
+
+
+@lru_cache(maxsize=512)
+def _frac_uncertainty_cached(expr: sympy.Expr, args_tuple: Tuple[sympy.Symbol, ...],
+                             assumptions_frozenset: FrozenSet[AppliedPredicate],
+                             refine: bool, delta_char: str) -> Expression:
+    """Calculate the fractional uncertainty of expr with respect to args_tuple, memoized like the absolute one.
+
+    The returned Expression is shared between callers and should not be mutated.
+
+    >>> uncertainty = _frac_uncertainty_cached(a + b, (a, b), frozenset(), True, 'Δ')
+    >>> uncertainty is _frac_uncertainty_cached(a + b, (a, b), frozenset(), True, 'Δ')
+    True
+    """
+    positive_syms, context = _refine_context(expr, args_tuple, assumptions_frozenset)
+    if isinstance(expr, (sympy.Mul, sympy.Pow)) and not expr.has(sympy.zoo, sympy.nan) and expr.is_zero is not True:
+        # |∂f/∂x| / |f| = |∂(log f)/∂x|, and the log of a product or power expands into simple terms.
+        # This is its own memoized pass over log f: it does not reuse the cached absolute uncertainty of f,
+        # so the first request for a product differentiates twice (re-submits are still lookups), in exchange
+        # for not dividing each absolute term by f symbolically
+        log_expr = sympy.expand_log(sympy.log(expr), force=True)
+        # expanding drops constant factors, so a factor of 0 or an undefined one only shows up here
+        if not log_expr.has(sympy.zoo, sympy.nan, sympy.oo, -sympy.oo):
+            return _abs_uncertainty_cached(log_expr, args_tuple, assumptions_frozenset, refine, delta_char)
+    absolute_uncertainty = _abs_uncertainty_cached(expr, args_tuple, assumptions_frozenset, refine, delta_char)
+    if absolute_uncertainty.expr == 0:  # e.g. no arg has an uncertainty, rather than rendering 0/f
+        return Expression(absolute_uncertainty.args, sympy.Integer(0))
+    # divided by |f| like the log path above, so that the fractional uncertainty is never negative
+    magnitude = _magnitude(expr, positive_syms, context, refine)
+    frac_uncertainty_expr = sympy.Integer(0)
+    if isinstance(absolute_uncertainty.expr, sympy.Add):
+        for addend in absolute_uncertainty.expr.args:
+            frac_uncertainty_expr += addend / magnitude
+    elif isinstance(absolute_uncertainty.expr, (sympy.Mul, sympy.Pow)):
+        frac_uncertainty_expr = absolute_uncertainty.expr / magnitude
+    else:
+        frac_uncertainty_expr = sympy.Mul(absolute_uncertainty.expr, sympy.Pow(magnitude, -1), evaluate=False)
+    return Expression(absolute_uncertainty.args, frac_uncertainty_expr)
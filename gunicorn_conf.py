@@ -0,0 +1,7 @@
+# Import the app (and so run its sympy warm-up) once in the master, before forking the workers,
+# so that they all start warm and share the warmed caches copy-on-write.
+preload_app = True
+
+# Restart a worker that has been silent for this many seconds. This must stay above CALCULATION_TIMEOUT in server.py,
+# which answers a runaway /calculate with a failure response before the worker would be killed.
+timeout = 1
@@ -1,8 +1,14 @@
 from flask import Flask, render_template, send_from_directory, request, jsonify
 from flask_cors import CORS
-from core import Expression
+from core import Expression, delta_name
 from constants import CONSTANTS, Ar
+import signal
 import sympy
+import sympy.printing.latex  # used by every response, import it with the app
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import List, Tuple
 
 app = Flask(__name__,
             static_folder='build/static',
@@ -10,6 +16,33 @@ app = Flask(__name__,
             )
 CORS(app)
 
+# seconds of symbolic work allowed per /calculate request, kept below gunicorn's worker timeout (gunicorn_conf.py)
+# so that a runaway calculation gets the failure response rather than a killed worker
+CALCULATION_TIMEOUT = 0.8
+
+
+@contextmanager
+def timeout(seconds: float):
+    """Raise TimeoutError inside the block once it has run for the given number of seconds.
+
+    This relies on SIGALRM, so it only applies in the main thread on Unix (e.g. gunicorn's sync workers),
+    elsewhere the block runs unbounded. In particular the threaded dev server (app.run) has no limit.
+    """
+    if not hasattr(signal, 'SIGALRM') or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def handle_alarm(signum, frame):
+        raise TimeoutError(f"calculation took longer than {seconds}s")
+
+    previous_handler = signal.signal(signal.SIGALRM, handle_alarm)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
 
 #########
 # Files
@@ -30,6 +63,18 @@ def send_favicon():
 # API
 #######
 
+@lru_cache(maxsize=1024)
+def _parse_expr(str_expr: str, use_constants: bool) -> Tuple[List[Tuple[str, str]], str]:
+    """Parse a string expression, memoized since the frontend resends the same expression while values are edited.
+
+    :return: the symbols as sorted 2-element tuples of plain string and latex, and the latex of the expression
+    """
+    expr = sympy.sympify(str_expr, evaluate=False, locals=CONSTANTS if use_constants else {'Ar': Ar})
+    symbols = expr.atoms(sympy.Symbol)
+    str_symbols = sorted([(str(symbol), sympy.latex(symbol)) for symbol in symbols])
+    return str_symbols, sympy.latex(sympy.sympify(str_expr))
+
+
 @app.route('/parse', methods=['POST'])
 def get_symbols():
     """Get the symbols in a string expression.
@@ -42,11 +87,8 @@ def get_symbols():
     str_expr = request.get_json().get('expr')
     use_constants = request.get_json().get('use_constants', False)
     try:
-        expr = sympy.sympify(str_expr, evaluate=False, locals=CONSTANTS if use_constants else {'Ar': Ar})
+        str_symbols, expression = _parse_expr(str_expr, bool(use_constants))
         success = True
-        symbols = expr.atoms(sympy.Symbol)
-        str_symbols = sorted([(str(symbol), sympy.latex(symbol)) for symbol in symbols])
-        expression = sympy.latex(sympy.sympify(str_expr))
     except Exception as e:
         success = False
         str_symbols = []
@@ -66,35 +108,51 @@ def calculate_uncertainties():
 
     :return: a json object with the following keys:
              - success: true if the calculations were performed without error in time, false otherwise
-             - value: the value obtained by evaluating the given expression at the given values
+             - value: the value obtained by evaluating the given expression at the given values,
+                      or an empty string (as for the other values) when some arg has no value yet
              - absoluteUncertaintyExpr: the expression of the absolute uncertainty
              - absoluteUncertainty: the value of the absolute uncertainty
              - fractionalUncertaintyExpr: the expression of the fractional uncertainty
              - percentageUncertainty: the value of the fractional uncertainty
     :return:
     """
-    str_expr = request.get_json().get('expr', '')
-    str_args = request.get_json().get('args', [])
-    str_vars = request.get_json().get('vars', [])  # positive vars
-    values = request.get_json().get('values', {})
-    prec = request.get_json().get('prec', 3)
-    refine = request.get_json().get('refine', False)
-    use_constants = request.get_json().get('use_constants', False)
+    payload = request.get_json(silent=True) or {}
+    str_expr = payload.get('expr', '')
+    str_args = payload.get('args', [])
+    str_vars = payload.get('vars', [])  # positive vars
+    values = payload.get('values', {})
+    prec = payload.get('prec', 3)
+    refine = payload.get('refine', False)
+    use_constants = payload.get('use_constants', False)
     try:
-        expr = Expression.from_string(str_args, str_expr, constants=CONSTANTS if use_constants else {'Ar': Ar})
-        assumptions = [sympy.Q.positive(sympy.Symbol(var)) for var in str_vars]
-        absolute_uncertainty_expr = expr.calculate_absolute_uncertainty(*assumptions, refine=refine)
-        fractional_uncertainty_expr = expr.calculate_fractional_uncertainty(*assumptions, refine=refine)
-        if use_constants:
-            values.update(CONSTANTS)
-        return jsonify({
-            "success": True,
-            "value": sympy.latex(expr.evaluate(values, precision=prec)),
-            "absoluteUncertaintyExpr": absolute_uncertainty_expr.to_latex(),
-            "absoluteUncertainty": sympy.latex(absolute_uncertainty_expr.evaluate(values, precision=prec)),
-            "fractionalUncertaintyExpr": fractional_uncertainty_expr.to_latex(),
-            "percentageUncertainty": sympy.latex(fractional_uncertainty_expr.evaluate(values, precision=prec) * 100)
-        })
+        with timeout(CALCULATION_TIMEOUT):
+            expr = Expression.from_string(str_args, str_expr, constants=CONSTANTS if use_constants else {'Ar': Ar},
+                                          positive_vars=str_vars)
+            # an arg given a zero uncertainty contributes nothing, so it is not differentiated
+            uncertain_vars = [var for var in expr.args if values.get(delta_name(var)) != 0]
+            absolute_uncertainty_expr = expr.calculate_absolute_uncertainty(refine=refine, uncertain_vars=uncertain_vars)
+            fractional_uncertainty_expr = expr.calculate_fractional_uncertainty(refine=refine,
+                                                                                uncertain_vars=uncertain_vars)
+            if not values or any(str(var) not in values for var in expr.args):
+                # the frontend is only after the symbolic uncertainties while the values are being entered
+                return jsonify({
+                    "success": True,
+                    "value": "",
+                    "absoluteUncertaintyExpr": absolute_uncertainty_expr.to_latex(),
+                    "absoluteUncertainty": '',
+                    "fractionalUncertaintyExpr": fractional_uncertainty_expr.to_latex(),
+                    "percentageUncertainty": ''
+                })
+            if use_constants:
+                values.update(CONSTANTS)
+            return jsonify({
+                "success": True,
+                "value": sympy.latex(expr.evaluate(values, precision=prec)),
+                "absoluteUncertaintyExpr": absolute_uncertainty_expr.to_latex(),
+                "absoluteUncertainty": sympy.latex(absolute_uncertainty_expr.evaluate(values, precision=prec)),
+                "fractionalUncertaintyExpr": fractional_uncertainty_expr.to_latex(),
+                "percentageUncertainty": sympy.latex(fractional_uncertainty_expr.evaluate(values, precision=prec) * 100)
+            })
     except Exception as e:
         print(e)
         return jsonify({
@@ -104,8 +162,28 @@ def calculate_uncertainties():
             "absoluteUncertainty": '',
             "fractionalUncertaintyExpr": '',
             "percentageUncertainty": ''
-        })
+        }), 503 if isinstance(e, TimeoutError) else 200
+
+
+def warm_up():
+    """Run a small calculation through the parsing, refining, evaluating and printing paths,
+    so that the first request after a start does not pay for sympy's cold caches.
+
+    This runs when the module is imported, so with gunicorn's preload_app the workers are forked already warm
+    and share these caches with the master.
+    """
+    _parse_expr('a*sin(b)', False)
+    # sin(b) leaves a sign for refine to decide
+    expr = Expression.from_string(['a', 'b'], 'a*sin(b)', constants={'Ar': Ar}, positive_vars=['a', 'b'])
+    values = {'a': 1.0, 'b': 1.0}
+    values.update({delta_name(var): 0.1 for var in expr.args})
+    for uncertainty in (expr.calculate_absolute_uncertainty(refine=True),
+                        expr.calculate_fractional_uncertainty(refine=True)):
+        sympy.latex(uncertainty.evaluate(values))
+        uncertainty.to_latex()
+
 
+warm_up()
 
 if __name__ == '__main__':
-    app.run()
+    app.run(threaded=True)